@@ -0,0 +1,38 @@
+"""Numba-compiled hot loops for ranking hospitals by distance."""
+import math
+
+import numpy as np
+from numba import njit
+
+EARTH_RADIUS_KM = 6371.0
+
+
+@njit(cache=True, fastmath=True)
+def haversine_km(lat0, lon0, lats, lons):
+    """Great-circle distance in km from (lat0, lon0) to every (lats[i], lons[i])."""
+    n = lats.shape[0]
+    out = np.empty(n, dtype=np.float32)
+    rlat0 = math.radians(lat0)
+    rlon0 = math.radians(lon0)
+    cos_lat0 = math.cos(rlat0)
+    for i in range(n):
+        rlat = math.radians(lats[i])
+        s_dlat = math.sin((rlat - rlat0) * 0.5)
+        s_dlon = math.sin((math.radians(lons[i]) - rlon0) * 0.5)
+        a = s_dlat * s_dlat + cos_lat0 * math.cos(rlat) * s_dlon * s_dlon
+        out[i] = 2.0 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+    return out
+
+
+@njit(cache=True)
+def rank_nearest(dist, beds):
+    """Slots with at least one free bed, nearest first (ties keep slot order)."""
+    n = dist.shape[0]
+    idx = np.empty(n, dtype=np.int64)
+    m = 0
+    for i in range(n):
+        if beds[i] > 0:
+            idx[m] = i
+            m += 1
+    idx = idx[:m]
+    return idx[np.argsort(dist[idx], kind="mergesort")]
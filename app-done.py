@@ -1,25 +1,46 @@
 import streamlit as st
 import google.generativeai as genai
-from google.generativeai.types import HarmCategory, HarmBlockThreshold
+from google.generativeai.types import (
+    BlockedPromptException,
+    HarmBlockThreshold,
+    HarmCategory,
+    StopCandidateException,
+)
+from google.api_core import exceptions as gax
+from pydantic import BaseModel, ValidationError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 import pandas as pd
+import numpy as np
 import time
 import json
+import orjson
+import hashlib
 import os
 import re
 import random
+import threading
+from types import MappingProxyType
+from typing import Literal, NamedTuple
 from streamlit_geolocation import streamlit_geolocation
+from _kernels import haversine_km, rank_nearest
 import requests
-from geopy.distance import geodesic
 
 # ================== CONFIGURATION ==================
-API_KEY = os.environ.get("GEMINI_API_KEY")
-if not API_KEY:
-    try:
-        API_KEY = st.secrets["GEMINI_API_KEY"]
-    except Exception:
-        API_KEY = "YOUR_NEW_KEY_HERE"
+def read_api_key():
+    api_key = os.environ.get("GEMINI_API_KEY")
+    if not api_key:
+        try:
+            api_key = st.secrets["GEMINI_API_KEY"]
+        # No secrets.toml raises a FileNotFoundError subclass; no such entry, KeyError
+        except (FileNotFoundError, KeyError):
+            api_key = "YOUR_NEW_KEY_HERE"
+    return api_key
 
-genai.configure(api_key=API_KEY)
+
+@st.cache_resource
+def configure_genai():
+    # genai.configure() rebuilds the client transport, so run it once per process.
+    genai.configure(api_key=read_api_key())
 
 # ================== 🛠️ MODEL SELECTOR ==================
 # Priority order: newest free Flash models first, then reliable fallbacks.
@@ -32,21 +53,137 @@ FREE_MODEL_PRIORITY = [
     "gemini-1.5-flash",
 ]
 
+FALLBACK_MODEL = "gemini-1.5-flash"
+
+
+def resolve_model_name():
+    """Pick the first priority model this key can use, with a single list_models() call."""
+    try:
+        available = {
+            m.name.removeprefix("models/")
+            for m in genai.list_models()
+            if "generateContent" in m.supported_generation_methods
+        }
+    except gax.GoogleAPIError:
+        return FALLBACK_MODEL
+    for model_name in FREE_MODEL_PRIORITY:
+        if model_name in available:
+            return model_name
+    return FALLBACK_MODEL
+
+
 @st.cache_resource
 def get_model():
-    for model_name in FREE_MODEL_PRIORITY:
-        try:
-            m = genai.GenerativeModel(model_name)
-            m.generate_content("ping")
-            return m, model_name
-        except Exception:
-            continue
-    fallback = "gemini-1.5-flash"
-    return genai.GenerativeModel(fallback), fallback
+    configure_genai()
+    model_name = resolve_model_name()
+    return genai.GenerativeModel(model_name), model_name
 
 model, active_model_name = get_model()
 
+# Failures the UI reports to the user instead of crashing the script.
+GEMINI_ERRORS = (
+    gax.GoogleAPIError,
+    BlockedPromptException,
+    StopCandidateException,
+    ValueError,  # unusable reply: parse_triage and extract_json raise it
+)
+
+
+@retry(
+    retry=retry_if_exception_type(gax.ServiceUnavailable),
+    wait=wait_exponential(multiplier=0.2, max=2.0),
+    stop=stop_after_attempt(3),
+    reraise=True,
+)
+def generate(prompt, **kwargs):
+    """model.generate_content with a short backoff on transient 503s."""
+    return model.generate_content(prompt, **kwargs)
+
+
+class ResponseCache:
+    """Prompt digest -> Gemini response text, bounded in size and age."""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, text = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            return text
+
+    def put(self, key, text):
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._entries.pop(next(iter(self._entries)))
+            self._entries[key] = (time.monotonic() + self.ttl, text)
+
+
+@st.cache_resource
+def get_response_cache():
+    # Shared by every session, so a repeated demo or rerun skips the round-trip.
+    return ResponseCache(ttl=3600, max_entries=256)
+
 # ================== 🧠 SHARED REAL-TIME MEMORY ==================
+class HospitalTable(NamedTuple):
+    """
+    Snapshot of the hospital network. Writers never mutate one in place: they
+    build a replacement and swap the reference, so a reader that grabbed
+    ``system.table`` once sees a consistent set of columns without locking.
+    """
+
+    records: dict  # name -> display record
+    names: np.ndarray  # slot i -> hospital name
+    slot: dict  # hospital name -> slot i
+    icu: np.ndarray
+    op: np.ndarray
+    lat: np.ndarray
+    lon: np.ndarray
+    dist: np.ndarray
+    total_icu: int  # kept in step with icu so reading it never sums the column
+    total_op: int
+
+
+def build_hospital_table(records, lat, lon):
+    names = list(records)
+    return with_distances(
+        HospitalTable(
+            records=records,
+            names=np.array(names, dtype=object),
+            slot={name: i for i, name in enumerate(names)},
+            # Narrow dtypes keep the ranking working set small and contiguous;
+            # float32 still resolves coordinates to well under a metre.
+            icu=np.array([records[n]["icu_beds"] for n in names], dtype=np.int16),
+            op=np.array([records[n]["op_beds"] for n in names], dtype=np.int16),
+            lat=np.array([records[n]["lat"] for n in names], dtype=np.float32),
+            lon=np.array([records[n]["lon"] for n in names], dtype=np.float32),
+            dist=None,
+            total_icu=sum(records[n]["icu_beds"] for n in names),
+            total_op=sum(records[n]["op_beds"] for n in names),
+        ),
+        lat,
+        lon,
+    )
+
+
+def with_distances(table, lat, lon):
+    dist = haversine_km(float(lat), float(lon), table.lat, table.lon)
+    records = {
+        # Round after widening: a rounded float32 widens to e.g. 0.6000000238418579.
+        name: {**table.records[name], "dist": round(float(d), 1)}
+        for name, d in zip(table.names, dist)
+    }
+    return table._replace(records=records, dist=dist)
+
+
 # FIX: @st.cache_resource must decorate a *function*, not a class directly.
 class SharedSystemState:
     def __init__(self):
@@ -55,10 +192,9 @@ class SharedSystemState:
         self.gps_locked = False
 
         # Default Mock Hospitals (Fallback)
-        self.hospitals = {
+        mock_hospitals = {
             "City General Trauma": {
                 "specialty": "Level 1 Trauma",
-                "dist": 5.2,
                 "icu_beds": 2,
                 "op_beds": 15,
                 "lat": 11.0200,
@@ -66,13 +202,13 @@ class SharedSystemState:
             },
             "Metropolitan Heart": {
                 "specialty": "Cardiology Center",
-                "dist": 8.5,
                 "icu_beds": 8,
                 "op_beds": 5,
                 "lat": 11.0300,
                 "lon": 76.9700,
             },
         }
+        self.table = build_hospital_table(mock_hospitals, self.base_lat, self.base_lon)
 
         self.mission = {
             "status": "IDLE",
@@ -82,19 +218,97 @@ class SharedSystemState:
             "live_vitals": {"bp": "120/80", "hr": 80, "spo2": 98},
             "telemetry_alert": "Stable",
             "ambulance_loc": {"lat": 11.0168, "lon": 76.9558},
+            "requested_at": 0.0,
+            # Gemini conversation for this mission: triage turn, then each re-evaluation
+            "chat_history": [],
         }
         self.declined_hospitals = []
 
-    def update_beds(self, hospital_name, ward_type):
-        if hospital_name not in self.hospitals:
+        # Every browser session runs in its own thread, so writes go through this lock.
+        self.lock = threading.Lock()
+        # Bumped on every write so sessions can tell when derived views are stale.
+        self.version = 0
+
+    @property
+    def hospitals(self):
+        return self.table.records
+
+    # Totals ride in the same snapshot as the beds, so they can never disagree.
+    @property
+    def total_icu(self):
+        return self.table.total_icu
+
+    @property
+    def total_op(self):
+        return self.table.total_op
+
+    def update_mission(self, **fields):
+        with self.lock:
+            self.mission.update(fields)
+            self.version += 1
+
+    def set_ambulance_location(self, lat, lon):
+        loc = {"lat": lat, "lon": lon}
+        with self.lock:
+            # The GPS widget reports the same fix on every rerun; only a real move is a write.
+            if self.mission["ambulance_loc"] == loc:
+                return False
+            self.mission["ambulance_loc"] = loc
+            self.table = with_distances(self.table, lat, lon)
+            self.version += 1
+            return True
+
+    def record_reeval(self, message, alert):
+        with self.lock:
+            # Copy-on-write so a reader holding the old history never sees it change.
+            self.mission["chat_history"] = self.mission["chat_history"] + [
+                {"role": "user", "parts": [message]},
+                {"role": "model", "parts": [alert]},
+            ]
+            self.mission["telemetry_alert"] = alert
+            self.version += 1
+
+    def decline_hospital(self, hospital_name):
+        with self.lock:
+            self.declined_hospitals.append(hospital_name)
+            self.mission["status"] = "DECLINED"
+            self.version += 1
+
+    def clear_declined(self):
+        with self.lock:
+            self.declined_hospitals = []
+            self.version += 1
+
+    def end_mission(self):
+        with self.lock:
+            self.mission["status"] = "IDLE"
+            self.declined_hospitals = []
+            self.version += 1
+
+    def admit(self, hospital_name, ward_type):
+        # Bed and status change together so no session sees one without the other.
+        with self.lock:
+            self._take_bed(hospital_name, ward_type)
+            self.mission["status"] = "ACTIVE"
+            self.version += 1
+
+    def _take_bed(self, hospital_name, ward_type):
+        # Caller holds self.lock.
+        table = self.table
+        if hospital_name not in table.records:
             return
-        if ward_type == "ICU":
-            self.hospitals[hospital_name]["icu_beds"] = max(
-                0, self.hospitals[hospital_name]["icu_beds"] - 1
-            )
-        else:
-            self.hospitals[hospital_name]["op_beds"] = max(
-                0, self.hospitals[hospital_name]["op_beds"] - 1
+        bed_key, column = ("icu_beds", "icu") if ward_type == "ICU" else ("op_beds", "op")
+        record = table.records[hospital_name]
+        if record[bed_key] > 0:
+            beds = getattr(table, column).copy()
+            beds[table.slot[hospital_name]] -= 1
+            records = {
+                **table.records,
+                hospital_name: {**record, bed_key: record[bed_key] - 1},
+            }
+            total = f"total_{column}"
+            self.table = table._replace(
+                records=records, **{column: beds, total: getattr(table, total) - 1}
             )
 
     # 🌍 REAL-WORLD HOSPITAL FETCHING
@@ -115,78 +329,156 @@ class SharedSystemState:
                 new_hospitals = {}
                 for node in data.get("elements", []):
                     name = node.get("tags", {}).get("name", "Unknown Medical Center")
-                    h_lat = float(node["lat"])
-                    h_lon = float(node["lon"])
-                    dist = round(geodesic((lat, lon), (h_lat, h_lon)).km, 1)
-
                     new_hospitals[name] = {
                         "specialty": "General / Emergency",
-                        "dist": dist,
                         "icu_beds": random.randint(0, 5),
                         "op_beds": random.randint(5, 20),
-                        "lat": h_lat,
-                        "lon": h_lon,
+                        "lat": float(node["lat"]),
+                        "lon": float(node["lon"]),
                     }
 
                 if new_hospitals:
-                    self.hospitals = new_hospitals
-                    self.base_lat = lat
-                    self.base_lon = lon
-                    self.gps_locked = True
+                    table = build_hospital_table(new_hospitals, lat, lon)
+                    with self.lock:
+                        self.table = table
+                        self.base_lat = lat
+                        self.base_lon = lon
+                        self.gps_locked = True
+                        self.version += 1
                     return True
-        except Exception:
+        except (requests.RequestException, ValueError, KeyError):
             pass
         return False
 
 
 @st.cache_resource
-def get_system_v2():
+def get_system_state():
     return SharedSystemState()
 
 
-system = get_system_v2()
+system = get_system_state()
 
 # ================== LOCAL SESSION STATE ==================
-if "analysis_result" not in st.session_state:
-    st.session_state.analysis_result = None
-if "gps_fetch_attempted" not in st.session_state:
-    st.session_state.gps_fetch_attempted = False
+SESSION_DEFAULTS = {
+    "analysis_result": None,
+    "triage_turns": [],
+    "ranked_hospitals": None,  # (system.version, {ward: ranking}) prefetched at triage
+    "pending_vitals": [],
+    "gps_acquired": None,
+}
+if not st.session_state.get("_inited"):
+    st.session_state.update(SESSION_DEFAULTS)
+    st.session_state._inited = True
 
 # ================== MOCK EMR DATA ==================
-emr_database = {
-    "P-101": {
-        "name": "Alex Mercer",
-        "age": 58,
-        "blood": "O+",
-        "history": "Hypertension",
-        "allergies": "Penicillin",
-    },
-    "P-102": {
-        "name": "Sarah Connor",
-        "age": 34,
-        "blood": "A+",
-        "history": "Asthma",
-        "allergies": "None",
-    },
-}
+@st.cache_resource
+def get_emr_database():
+    # Built once per process and shared read-only by every session.
+    return MappingProxyType(
+        {
+            "P-101": {
+                "name": "Alex Mercer",
+                "age": 58,
+                "blood": "O+",
+                "history": "Hypertension",
+                "allergies": "Penicillin",
+            },
+            "P-102": {
+                "name": "Sarah Connor",
+                "age": 34,
+                "blood": "A+",
+                "history": "Asthma",
+                "allergies": "None",
+            },
+        }
+    )
 
-# ================== APP SETUP ==================
-st.set_page_config(page_title="ResQ | Medicare App", page_icon="🚑", layout="wide")
 
-st.markdown(
-    """
+emr_database = get_emr_database()
+
+# ================== DISPLAY CONSTANTS ==================
+LOGO_PATH = "resq_logo.jpeg"
+
+APP_CSS = """
 <style>
     .stButton>button { width: 100%; border-radius: 8px; height: 3em; font-weight: bold; }
     div[data-testid="stMetricValue"] { font-size: 2.2rem; }
 </style>
-""",
-    unsafe_allow_html=True,
+"""
+
+# Severity index (0-10) -> acuity colour: 0-4 green, 5-7 orange, 8-10 red
+SEVERITY_COLORS = ("green",) * 5 + ("orange",) * 3 + ("red",) * 3
+
+# ================== 🧾 PROMPTS ==================
+# Static instructions go first and per-call values last, so repeated calls share
+# a byte-identical prefix that Gemini's implicit context cache can reuse.
+TRIAGE_INSTRUCTIONS = """You are an Expert Trauma Triage AI assistant.
+
+Task: Analyze the patient below and return ONLY a valid JSON object with exactly these four fields:
+- "severity": integer between 1 and 10 (1=minor, 10=critical)
+- "ward_need": string, must be exactly "ICU" or "OP"
+- "reason": string, max 40 words, clinical assessment
+- "monitor_directive": string, max 25 words, which vitals to watch in transit and the thresholds that mean deterioration
+
+Return ONLY the raw JSON object. No markdown, no explanation, no code fences. Example:
+{"severity": 7, "ward_need": "ICU", "reason": "Patient presents with acute chest pain and low SpO2 consistent with cardiac event requiring intensive monitoring.", "monitor_directive": "Watch SpO2 and HR; escalate if SpO2 < 90% or HR > 130 bpm."}
+"""
+
+
+class Triage(BaseModel):
+    severity: int
+    ward_need: Literal["ICU", "OP"]
+    reason: str
+    monitor_directive: str
+
+
+REEVAL_INSTRUCTIONS = (
+    "The patient above is now in transit and you are monitoring them "
+    "for the receiving doctor. "
+    "Task: Provide a 1-sentence plain-text status update based on the new vitals, "
+    "judged against your monitor directive.\n"
 )
 
+def patient_fragment(patient):
+    # Terse fixed-order EMR summary: no braces, quotes or key names to spend tokens on.
+    if not patient:
+        return "UNIDENTIFIED PATIENT / UNKNOWN HISTORY"
+    return (
+        f"{patient['name']},{patient['age']}y,{patient['blood']},"
+        f"Hx:{patient['history']},All:{patient['allergies']}"
+    )
+
+
+def build_triage_prompt(patient_data, bp, hr, spo2, notes):
+    return (
+        f"{TRIAGE_INSTRUCTIONS}\n"
+        f"Patient Data: {patient_data}\n"
+        f"Vitals: BP {bp}, HR {hr}, SpO2 {spo2}\n"
+        f"Clinical Notes: {notes}"
+    )
+
+
+def build_reeval_prompt(readings):
+    # Sent as the next turn of the mission chat, which already carries the triage context.
+    vitals = "; ".join(f"BP {v['bp']}, HR {v['hr']}, SpO2 {v['spo2']}" for v in readings)
+    return f"{REEVAL_INSTRUCTIONS}NEW VITALS (oldest first): {vitals}."
+
+
+# ================== APP SETUP ==================
+st.set_page_config(page_title="ResQ | Medicare App", page_icon="🚑", layout="wide")
+
+st.markdown(APP_CSS, unsafe_allow_html=True)
+
+
+@st.cache_data
+def logo_available():
+    return os.path.exists(LOGO_PATH)
+
+
 # --- SIDEBAR ---
 with st.sidebar:
-    if os.path.exists("resq_logo.jpeg"):
-        st.image("resq_logo.jpeg", use_container_width=True)
+    if logo_available():
+        st.image(LOGO_PATH, use_container_width=True)
     else:
         st.markdown("## ResQ Medicare")
 
@@ -211,42 +503,321 @@ with st.sidebar:
 def safe_int(val):
     try:
         return int(val)
-    except Exception:
+    except (TypeError, ValueError):
         return 0
 
 
+# Outermost {...} span; fences and prose around the object fall outside it
+JSON_OBJECT_RE = re.compile(rb"\{.*\}", re.DOTALL)
+
+
 def extract_json(text: str) -> dict:
     """
     Robustly extract a JSON object from an AI response that may contain
     markdown code fences, extra prose, or both.
     """
-    # Strip common markdown code fences
-    text = re.sub(r"```(?:json)?", "", text).replace("```", "").strip()
+    raw = text.encode()
     # Try a direct parse first
     try:
-        return json.loads(text)
-    except json.JSONDecodeError:
+        result = orjson.loads(raw)
+        if isinstance(result, dict):
+            return result
+    except orjson.JSONDecodeError:
         pass
-    # Fall back to regex: grab the first {...} block
-    match = re.search(r"\{.*?\}", text, re.DOTALL)
+    # Fall back to regex: slice from the first '{' to the last '}'
+    match = JSON_OBJECT_RE.search(raw)
     if match:
         try:
-            return json.loads(match.group())
-        except json.JSONDecodeError:
+            result = orjson.loads(match.group())
+            if isinstance(result, dict):
+                return result
+        except orjson.JSONDecodeError:
             pass
+    # Anything but an object (e.g. a bare "ICU") is as unusable as invalid JSON
     raise ValueError(f"Could not extract valid JSON from AI response:\n{text}")
 
 
+# Map frames are built column-wise and only when the coordinates actually change.
+@st.cache_data(max_entries=8)
+def route_map_df(amb_lat, amb_lon, dest_lat, dest_lon):
+    """Ambulance (red) and destination hospital (green) markers for st.map."""
+    return pd.DataFrame(
+        {
+            "lat": [amb_lat, dest_lat],
+            "lon": [amb_lon, dest_lon],
+            "size": [20, 20],
+            "color": ["#ff0000", "#00ff00"],
+        }
+    )
+
+
+@st.cache_data(max_entries=8)
+def network_map_df(amb_lat, amb_lon, hosp_lats, hosp_lons):
+    """Ambulance (red) plus every hospital in the network (blue) for st.map."""
+    n = len(hosp_lats)
+    return pd.DataFrame(
+        {
+            "lat": np.concatenate(([amb_lat], hosp_lats)),
+            "lon": np.concatenate(([amb_lon], hosp_lons)),
+            "size": [20] + [15] * n,
+            "color": ["#ff0000"] + ["#0000ff"] * n,
+        }
+    )
+
+
+def parse_triage(text):
+    """Validate a triage response against the schema, salvaging off-schema output."""
+    try:
+        result = Triage.model_validate_json(text).model_dump()
+    except ValidationError:
+        result = extract_json(text)
+
+    # Validate and normalise fields
+    try:
+        severity = int(result.get("severity", 5))
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Triage severity is not a number: {result.get('severity')!r}") from e
+    result["severity"] = max(1, min(10, severity))
+    ward = str(result.get("ward_need", "OP")).strip().upper()
+    result["ward_need"] = "ICU" if "ICU" in ward else "OP"
+    result["reason"] = str(result.get("reason", "Assessment incomplete."))
+    result["monitor_directive"] = str(result.get("monitor_directive", ""))
+    return result
+
+
+@st.cache_data(max_entries=8)
+def census_df(names, icu_beds, op_beds, specialties):
+    """Network Census Board frame; rebuilt only when a bed count or the hospital set changes."""
+    return pd.DataFrame(
+        {
+            "Facility Name": names,
+            "ICU Vacancy": icu_beds,
+            "Gen Ward Vacancy": op_beds,
+            "Specialty": specialties,
+        }
+    )
+
+
+def stream_text(response):
+    """Yield the text of each streamed Gemini chunk, skipping chunks without parts."""
+    for chunk in response:
+        if chunk.parts:
+            yield chunk.text
+
+
+# Structured output: Gemini returns an object matching Triage, so no fences to strip.
+TRIAGE_CONFIG = genai.GenerationConfig(
+    response_mime_type="application/json", response_schema=Triage
+)
+
+
+def cached_generate(contents, container=None, render=None, parse=None, **kwargs):
+    """
+    Stream a Gemini response into ``container`` (the current one by default) and
+    return its text, or return the stored text straight away when the identical
+    request was answered by any session within the last hour.
+
+    ``render`` maps the text received so far to the markdown shown while
+    streaming; without it the raw chunks are written as they arrive. Only a
+    non-empty reply that ``parse`` (when given) accepts is stored, so a bad
+    reply raises here and the next attempt asks Gemini again.
+    """
+    material = json.dumps(contents, sort_keys=True) + repr(kwargs)
+    key = hashlib.blake2b(material.encode(), digest_size=16).hexdigest()
+    cache = get_response_cache()
+    text = cache.get(key)
+    if text is None:
+        response = generate(contents, stream=True, **kwargs)
+        target = container or st
+        if render is None:
+            text = target.write_stream(stream_text(response))
+        else:
+            placeholder = target.empty()
+            text = ""
+            for piece in stream_text(response):
+                text += piece
+                placeholder.markdown(render(text))
+        if parse is not None:
+            parse(text)
+        if text:
+            cache.put(key, text)
+    return text
+
+
+# Opening of the "reason" string in a JSON reply that may still be mid-stream
+PARTIAL_REASON_RE = re.compile(r'"reason"\s*:\s*"((?:[^"\\]|\\.)*)')
+
+
+def partial_reason(text):
+    """Show the clinical reason as it streams instead of the raw JSON around it."""
+    match = PARTIAL_REASON_RE.search(text)
+    if not match:
+        return "🩺 …"
+    reason = match.group(1)
+    # Decode JSON escapes (\" and \n); a chunk that ends mid-escape shows raw until the rest arrives
+    try:
+        reason = orjson.loads(f'"{reason}"')
+    except orjson.JSONDecodeError:
+        pass
+    return f"🩺 {reason}"
+
+
+def commit_and_rerun(**mission_fields):
+    """Publish a mission transition as one locked write, then rerun exactly once."""
+    system.update_mission(**mission_fields)
+    st.rerun()
+
+
 def find_best_hospital(required_ward):
-    eligible = []
-    for name, data in system.hospitals.items():
-        if name in system.declined_hospitals:
-            continue
-        if required_ward == "ICU" and data["icu_beds"] > 0:
-            eligible.append((name, data))
-        elif required_ward == "OP" and data["op_beds"] > 0:
-            eligible.append((name, data))
-    return sorted(eligible, key=lambda x: x[1]["dist"])
+    table = system.table
+    beds = table.icu if required_ward == "ICU" else table.op
+    nearest_first = rank_nearest(table.dist, beds)
+    declined = system.declined_hospitals
+    return [
+        (name, table.records[name])
+        for name in table.names[nearest_first]
+        if name not in declined
+    ]
+
+
+@st.fragment(run_every=0.5)
+def await_hospital_response():
+    """Poll only this fragment while PENDING; rerun the full page once the hospital answers."""
+    if system.mission["status"] != "PENDING":
+        st.rerun()
+    # Elapsed time comes from a stored timestamp, so the wait never blocks the thread.
+    waited = time.monotonic() - system.mission["requested_at"]
+    st.caption(f"⏳ Establishing secure telemetry link... ({waited:.0f}s)")
+
+
+@st.fragment(run_every=1.0)
+def watch_shared_state(rendered_version):
+    """Rerun the full page as soon as another session writes to the shared state."""
+    if system.version != rendered_version:
+        st.rerun()
+
+
+@st.fragment
+def telemetry_panel():
+    """Vitals inputs rerun only this panel on each keystroke, not the map above."""
+    st.subheader("📡 LIVE PATIENT TELEMETRY")
+
+    vc1, vc2, vc3, vc4 = st.columns(4)
+    with vc1:
+        new_bp = st.text_input("BP (mmHg)", value=system.mission["live_vitals"]["bp"])
+    with vc2:
+        new_hr = st.number_input(
+            "Heart Rate (BPM)", value=safe_int(system.mission["live_vitals"]["hr"])
+        )
+    with vc3:
+        new_spo2 = st.number_input(
+            "SpO2 (%)", value=safe_int(system.mission["live_vitals"]["spo2"])
+        )
+    with vc4:
+        st.write("")
+        st.write("")
+        if st.button("📡 TRANSMIT & RE-EVALUATE"):
+            reading = {"bp": new_bp, "hr": new_hr, "spo2": new_spo2}
+            system.update_mission(live_vitals=reading)
+            # Readings from failed calls stay queued and ride along with this one,
+            # so a retry re-sends them in one call instead of one call each.
+            st.session_state.pending_vitals.append(reading)
+            prompt = build_reeval_prompt(st.session_state.pending_vitals)
+            contents = system.mission["chat_history"] + [
+                {"role": "user", "parts": [prompt]}
+            ]
+            try:
+                alert = cached_generate(contents, container=st.empty())
+            except GEMINI_ERRORS as e:
+                st.error(f"AI Re-evaluation failed: {e}")
+            else:
+                # A blocked or part-less stream comes back empty; recording it
+                # would put an empty model turn in the history Gemini rejects.
+                if not alert:
+                    st.error("AI Re-evaluation failed: Gemini returned no text.")
+                else:
+                    system.record_reeval(prompt, alert)
+                    st.session_state.pending_vitals = []
+                    st.toast("✅ Vitals & Analysis Sent to Hospital", icon="📡")
+                    st.rerun(scope="fragment")
+
+    if (
+        system.mission["telemetry_alert"]
+        and system.mission["telemetry_alert"] != "Stable"
+    ):
+        st.info(f"**AI LIVE MONITOR:** {system.mission['telemetry_alert']}")
+
+
+def report_hospital_fetch(success, moved):
+    """Announce a hospital fetch and rerun the page if anything outside the fragment changed."""
+    # A toast survives the rerun, so no sleep is needed to show it.
+    if success:
+        st.toast("✅ LOCAL HOSPITALS FOUND!")
+        st.rerun()
+    warning = "⚠️ Could not reach OpenStreetMap. Using simulation hospitals."
+    if moved:
+        # The simulation hospitals stay, but their distances and the route map follow the new fix.
+        st.toast(warning)
+        st.rerun()
+    st.warning(warning)
+
+
+@st.fragment
+def gps_panel():
+    """Location widget and manual entry rerun on their own; a new hospital set reruns the page."""
+    col_gps, col_info = st.columns([1, 2])
+    with col_gps:
+        st.caption("📍 GET REAL-TIME LOCATION")
+        # One fix per session: once acquired the widget is no longer rendered, so it
+        # cannot re-query the browser or trigger further reruns.
+        if st.session_state.gps_acquired is None:
+            location = streamlit_geolocation()
+            if location and location.get("latitude") is not None:
+                fix = (location["latitude"], location["longitude"])
+                st.session_state.gps_acquired = fix
+                moved = system.set_ambulance_location(*fix)
+                if system.gps_locked:
+                    # Distances and map markers outside this fragment follow the new fix.
+                    st.rerun()
+                with st.spinner("📡 SCANNING SATELLITE & FINDING LOCAL HOSPITALS..."):
+                    success = system.fetch_real_hospitals(*fix)
+                report_hospital_fetch(success, moved)
+        else:
+            fix_lat, fix_lon = st.session_state.gps_acquired
+            st.success(f"📍 FIX ACQUIRED: {fix_lat:.4f}, {fix_lon:.4f}")
+
+    with col_info:
+        if system.gps_locked:
+            st.success(
+                f"✅ GPS LOCKED: {system.base_lat:.4f}, {system.base_lon:.4f}"
+            )
+        else:
+            st.info("⚠️ Click the button to fetch REAL hospitals near you.")
+
+        st.markdown("---")
+        with st.expander("📍 Enter Location Manually"):
+            m_lat = st.number_input("Latitude", value=system.base_lat, format="%.4f")
+            m_lon = st.number_input("Longitude", value=system.base_lon, format="%.4f")
+            if st.button("🔍 FETCH HOSPITALS AT COORDINATES", use_container_width=True):
+                moved = system.set_ambulance_location(m_lat, m_lon)
+                with st.spinner("📡 SCANNING LOCAL HOSPITALS..."):
+                    success = system.fetch_real_hospitals(m_lat, m_lon)
+                report_hospital_fetch(success, moved)
+
+
+WARDS = ("ICU", "OP")
+
+
+def rank_all_wards():
+    return {ward: find_best_hospital(ward) for ward in WARDS}
+
+
+def ranked_hospitals(required_ward):
+    """Use the ranking prefetched during triage unless shared state has changed since."""
+    prefetched = st.session_state.ranked_hospitals
+    if prefetched and prefetched[0] == system.version:
+        return prefetched[1][required_ward]
+    return find_best_hospital(required_ward)
 
 
 # ================== PAGE 1: AMBULANCE COMMAND ==================
@@ -271,23 +842,11 @@ if page == "🚑 EMS UNIT (AMBULANCE)":
         c3.metric("STATUS", "EN ROUTE")
 
         st.subheader("📍 LIVE GPS TRACKING")
-        map_data = pd.DataFrame(
-            [
-                {
-                    "lat": system.mission["ambulance_loc"]["lat"],
-                    "lon": system.mission["ambulance_loc"]["lon"],
-                    "type": "🚑 AMBULANCE",
-                    "size": 20,
-                    "color": "#ff0000",
-                },
-                {
-                    "lat": dest_data["lat"],
-                    "lon": dest_data["lon"],
-                    "type": "🏥 HOSPITAL",
-                    "size": 20,
-                    "color": "#00ff00",
-                },
-            ]
+        map_data = route_map_df(
+            system.mission["ambulance_loc"]["lat"],
+            system.mission["ambulance_loc"]["lon"],
+            dest_data["lat"],
+            dest_data["lon"],
         )
         st.map(
             map_data,
@@ -299,56 +858,16 @@ if page == "🚑 EMS UNIT (AMBULANCE)":
         )
 
         st.divider()
-        st.subheader("📡 LIVE PATIENT TELEMETRY")
-
-        vc1, vc2, vc3, vc4 = st.columns(4)
-        with vc1:
-            new_bp = st.text_input("BP (mmHg)", value=system.mission["live_vitals"]["bp"])
-        with vc2:
-            new_hr = st.number_input(
-                "Heart Rate (BPM)", value=safe_int(system.mission["live_vitals"]["hr"])
-            )
-        with vc3:
-            new_spo2 = st.number_input(
-                "SpO2 (%)", value=safe_int(system.mission["live_vitals"]["spo2"])
-            )
-        with vc4:
-            st.write("")
-            st.write("")
-            if st.button("📡 TRANSMIT & RE-EVALUATE"):
-                system.mission["live_vitals"] = {
-                    "bp": new_bp,
-                    "hr": new_hr,
-                    "spo2": new_spo2,
-                }
-                with st.spinner("AI Analyzing New Vitals..."):
-                    prompt = f"""
-                    Patient Re-evaluation. Previous Status: {system.mission['ai_analysis']['reason']}
-                    NEW VITALS: BP {new_bp}, HR {new_hr}, SpO2 {new_spo2}.
-                    Task: Provide a 1-sentence status update for the receiving doctor.
-                    """
-                    try:
-                        resp = model.generate_content(prompt)
-                        system.mission["telemetry_alert"] = resp.text
-                        st.toast("✅ Vitals & Analysis Sent to Hospital", icon="📡")
-                        st.rerun()
-                    except Exception as e:
-                        st.error(f"AI Re-evaluation failed: {e}")
-
-        if (
-            system.mission["telemetry_alert"]
-            and system.mission["telemetry_alert"] != "Stable"
-        ):
-            st.info(f"**AI LIVE MONITOR:** {system.mission['telemetry_alert']}")
+        telemetry_panel()
 
         st.divider()
         if st.button(
             "✅ TRANSFER COMPLETE: HANDOVER VERIFIED", type="primary"
         ):
-            system.mission["status"] = "IDLE"
-            system.declined_hospitals = []
+            system.end_mission()
             st.session_state.analysis_result = None
-            st.session_state.gps_fetch_attempted = False
+            st.session_state.pending_vitals = []
+            st.session_state.gps_acquired = None
             st.rerun()
 
     # 2. PENDING — WAITING FOR HOSPITAL RESPONSE
@@ -358,10 +877,7 @@ if page == "🚑 EMS UNIT (AMBULANCE)":
             f"### ⏳ AWAITING ADMISSION AUTH: {(system.mission['target_hospital'] or 'UNKNOWN').upper()}"
         )
         st.info("Medical Command Center notified. Standby for handshake protocol.")
-
-        with st.spinner("Establishing secure telemetry link..."):
-            time.sleep(2)
-            st.rerun()
+        await_hospital_response()
 
     # 3. DECLINED — DIVERSION REQUIRED
     elif system.mission["status"] == "DECLINED":
@@ -370,62 +886,13 @@ if page == "🚑 EMS UNIT (AMBULANCE)":
             f"{system.mission['target_hospital']} reports ZERO CAPACITY. Initiate Diversion Protocol."
         )
         if st.button("🔄 INITIATE DIVERSION (SELECT ALTERNATE)", type="primary"):
-            system.mission["status"] = "IDLE"
-            st.rerun()
+            commit_and_rerun(status="IDLE")
 
     # 4. IDLE — DIAGNOSTICS & HOSPITAL SELECTION
     else:
         st.title("🚑 ResQ PRE-HOSPITAL ASSESSMENT")
 
-        col_gps, col_info = st.columns([1, 2])
-        with col_gps:
-            st.caption("📍 GET REAL-TIME LOCATION")
-            location = streamlit_geolocation()
-
-            # FIX: Only attempt fetch when we have valid coordinates AND haven't locked yet.
-            if location and location.get("latitude") is not None:
-                user_lat = location["latitude"]
-                user_lon = location["longitude"]
-                system.mission["ambulance_loc"] = {"lat": user_lat, "lon": user_lon}
-
-                if not system.gps_locked and not st.session_state.gps_fetch_attempted:
-                    # Mark attempt so we don't retry in a loop on every rerun
-                    st.session_state.gps_fetch_attempted = True
-                    with st.spinner("📡 SCANNING SATELLITE & FINDING LOCAL HOSPITALS..."):
-                        success = system.fetch_real_hospitals(user_lat, user_lon)
-                    if success:
-                        st.success("✅ LOCAL HOSPITALS FOUND!")
-                        time.sleep(1)
-                        st.rerun()
-                    else:
-                        st.warning(
-                            "⚠️ Could not reach OpenStreetMap. Using simulation hospitals."
-                        )
-
-        with col_info:
-            if system.gps_locked:
-                st.success(
-                    f"✅ GPS LOCKED: {system.base_lat:.4f}, {system.base_lon:.4f}"
-                )
-            else:
-                st.info("⚠️ Click the button to fetch REAL hospitals near you.")
-
-            st.markdown("---")
-            with st.expander("📍 Enter Location Manually"):
-                m_lat = st.number_input("Latitude", value=system.base_lat, format="%.4f")
-                m_lon = st.number_input("Longitude", value=system.base_lon, format="%.4f")
-                if st.button("🔍 FETCH HOSPITALS AT COORDINATES", use_container_width=True):
-                    system.mission["ambulance_loc"] = {"lat": m_lat, "lon": m_lon}
-                    with st.spinner("📡 SCANNING LOCAL HOSPITALS..."):
-                        success = system.fetch_real_hospitals(m_lat, m_lon)
-                    if success:
-                        st.success("✅ LOCAL HOSPITALS FOUND!")
-                        time.sleep(1)
-                        st.rerun()
-                    else:
-                        st.warning(
-                            "⚠️ Could not reach OpenStreetMap. Using simulation hospitals."
-                        )
+        gps_panel()
 
         st.divider()
         c1, c2 = st.columns([1, 2])
@@ -475,47 +942,43 @@ if page == "🚑 EMS UNIT (AMBULANCE)":
             if not notes:
                 st.toast("⚠️ Input Error: Clinical notes required.")
             else:
-                system.declined_hospitals = []
-                patient_data_str = (
-                    str(patient) if patient else "UNIDENTIFIED PATIENT / UNKNOWN HISTORY"
+                system.clear_declined()
+                patient_data_str = patient_fragment(patient)
+                system.update_mission(
+                    live_vitals={
+                        "bp": bp_input if bp_input else "N/A",
+                        "hr": hr_input if hr_input > 0 else "N/A",
+                        "spo2": spo2_input if spo2_input > 0 else "N/A",
+                    }
                 )
-                system.mission["live_vitals"] = {
-                    "bp": bp_input if bp_input else "N/A",
-                    "hr": hr_input if hr_input > 0 else "N/A",
-                    "spo2": spo2_input if spo2_input > 0 else "N/A",
-                }
 
-                with st.spinner("🤖 PROCESSING BIOMETRICS..."):
-                    prompt = f"""You are an Expert Trauma Triage AI assistant.
-
-Patient Data: {patient_data_str}
-Vitals: BP {bp_input}, HR {hr_input}, SpO2 {spo2_input}
-Clinical Notes: {notes}
-
-Task: Analyze the patient and return ONLY a valid JSON object with exactly these three fields:
-- "severity": integer between 1 and 10 (1=minor, 10=critical)
-- "ward_need": string, must be exactly "ICU" or "OP"
-- "reason": string, max 40 words, clinical assessment
-
-Return ONLY the raw JSON object. No markdown, no explanation, no code fences. Example:
-{{"severity": 7, "ward_need": "ICU", "reason": "Patient presents with acute chest pain and low SpO2 consistent with cardiac event requiring intensive monitoring."}}"""
+                with st.status("🤖 PROCESSING BIOMETRICS...", expanded=True):
+                    prompt = build_triage_prompt(
+                        patient_data_str, bp_input, hr_input, spo2_input, notes
+                    )
 
                     try:
                         safe = {
                             HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE
                         }
-                        response = model.generate_content(prompt, safety_settings=safe)
-                        result = extract_json(response.text)
-
-                        # Validate and normalise fields
-                        result["severity"] = max(1, min(10, int(result.get("severity", 5))))
-                        ward = str(result.get("ward_need", "OP")).strip().upper()
-                        result["ward_need"] = "ICU" if "ICU" in ward else "OP"
-                        result["reason"] = str(result.get("reason", "Assessment incomplete."))
+                        triage_text = cached_generate(
+                            prompt,
+                            render=partial_reason,
+                            safety_settings=safe,
+                            generation_config=TRIAGE_CONFIG,
+                            parse=parse_triage,
+                        )
+                        result = parse_triage(triage_text)
+                        # Both wards are ranked now so the results view can reuse them.
+                        st.session_state.ranked_hospitals = (system.version, rank_all_wards())
 
                         st.session_state.analysis_result = result
+                        st.session_state.triage_turns = [
+                            {"role": "user", "parts": [prompt]},
+                            {"role": "model", "parts": [triage_text]},
+                        ]
                         st.rerun()
-                    except Exception as e:
+                    except GEMINI_ERRORS as e:
                         st.error(f"AI ERROR: {e}")
                         st.info(
                             "Tip: Check your API key in st.secrets or the app config."
@@ -528,71 +991,72 @@ Return ONLY the raw JSON object. No markdown, no explanation, no code fences. Ex
             st.markdown("### 🤖 CLINICAL ACUITY REPORT")
             c1, c2 = st.columns([1, 2])
             sev = r["severity"]
-            color = "red" if sev > 7 else "orange" if sev > 4 else "green"
+            color = SEVERITY_COLORS[min(max(sev, 0), 10)]
             with c1:
                 st.markdown(f"**SEVERITY INDEX**: :{color}[**{sev}/10**]")
                 st.metric("REQUIRED UNIT", r["ward_need"])
             with c2:
                 st.info(f"**AI ASSESSMENT:**\n\n{r['reason']}", icon="🩺")
+                if r.get("monitor_directive"):
+                    st.caption(f"**MONITOR:** {r['monitor_directive']}")
 
             st.markdown("### 🏥 SELECT DESTINATION FACILITY")
-            hospitals = find_best_hospital(r["ward_need"])
-
-            # Build map with ambulance + all candidate hospitals
-            map_pts = [
-                {
-                    "lat": system.mission["ambulance_loc"]["lat"],
-                    "lon": system.mission["ambulance_loc"]["lon"],
-                    "color": "#ff0000",
-                    "size": 20,
-                }
-            ]
-            for name, data in system.hospitals.items():
-                map_pts.append(
-                    {
-                        "lat": data["lat"],
-                        "lon": data["lon"],
-                        "color": "#0000ff",
-                        "size": 15,
-                    }
-                )
-            st.map(pd.DataFrame(map_pts), color="color", size="size", zoom=12)
+            hospitals = ranked_hospitals(r["ward_need"])
+
+            # Map with ambulance + all candidate hospitals
+            map_data = network_map_df(
+                system.mission["ambulance_loc"]["lat"],
+                system.mission["ambulance_loc"]["lon"],
+                system.table.lat,
+                system.table.lon,
+            )
+            st.map(map_data, color="color", size="size", zoom=12)
 
             if not hospitals:
                 st.error("🚨 CRITICAL: NO HOSPITALS WITH REQUIRED CAPACITY FOUND NEARBY")
-
-            for name, data in hospitals:
-                with st.container():
-                    col_det, col_btn = st.columns([3, 1])
-                    with col_det:
-                        st.markdown(f"**{name}**")
-                        capacity = (
-                            data["icu_beds"]
-                            if r["ward_need"] == "ICU"
-                            else data["op_beds"]
-                        )
-                        st.caption(
-                            f"🚗 {data['dist']}km | {r['ward_need']} Capacity: {capacity}"
-                        )
-                    with col_btn:
-                        if name in system.declined_hospitals:
-                            st.button(f"⛔ REFUSED", key=f"btn_{name}", disabled=True)
-                        else:
-                            if st.button(f"🚑 REQUEST ADMISSION", key=f"btn_{name}"):
-                                system.mission["status"] = "PENDING"
-                                system.mission["target_hospital"] = name
-                                system.mission["patient_data"] = (
-                                    patient
-                                    if patient
-                                    else {"name": "Unidentified", "age": "Unknown"}
-                                )
-                                system.mission["ai_analysis"] = r
-                                st.rerun()
-                    st.divider()
+            else:
+                # One radio + submit instead of a button per facility: a single widget
+                # to register and a single rerun when the crew commits to a choice.
+                candidates = dict(hospitals)
+                bed_key = "icu_beds" if r["ward_need"] == "ICU" else "op_beds"
+
+                def describe(name):
+                    data = candidates[name]
+                    return (
+                        f"{name} — 🚗 {data['dist']}km | "
+                        f"{r['ward_need']} Capacity: {data[bed_key]}"
+                    )
+
+                with st.form("admission_request"):
+                    choice = st.radio(
+                        "Nearest facilities with capacity",
+                        list(candidates),
+                        format_func=describe,
+                    )
+                    submitted = st.form_submit_button(
+                        "🚑 REQUEST ADMISSION", type="primary"
+                    )
+                if submitted:
+                    commit_and_rerun(
+                        status="PENDING",
+                        target_hospital=choice,
+                        patient_data=(
+                            patient
+                            if patient
+                            else {"name": "Unidentified", "age": "Unknown"}
+                        ),
+                        ai_analysis=r,
+                        chat_history=st.session_state.triage_turns,
+                        requested_at=time.monotonic(),
+                    )
+
+            if system.declined_hospitals:
+                st.caption("⛔ REFUSED: " + ", ".join(system.declined_hospitals))
 
 # ================== PAGE 2: HOSPITAL OPS ==================
 else:
     st.title("🏥 MEDICAL COMMAND CENTER")
+    watch_shared_state(system.version)
 
     if system.mission["status"] == "ACTIVE":
         patient_name = (system.mission.get('patient_data') or {}).get('name', 'UNKNOWN')
@@ -608,23 +1072,11 @@ else:
         else:
             h_data = list(system.hospitals.values())[0]
 
-        map_data = pd.DataFrame(
-            [
-                {
-                    "lat": system.mission["ambulance_loc"]["lat"],
-                    "lon": system.mission["ambulance_loc"]["lon"],
-                    "type": "🚑 UNIT",
-                    "size": 20,
-                    "color": "#ff0000",
-                },
-                {
-                    "lat": h_data["lat"],
-                    "lon": h_data["lon"],
-                    "type": "🏥 HOSPITAL",
-                    "size": 20,
-                    "color": "#00ff00",
-                },
-            ]
+        map_data = route_map_df(
+            system.mission["ambulance_loc"]["lat"],
+            system.mission["ambulance_loc"]["lon"],
+            h_data["lat"],
+            h_data["lon"],
         )
         st.map(
             map_data,
@@ -665,6 +1117,8 @@ else:
         with c1:
             st.write(f"**Patient:** {patient['name']} ({patient['age']})")
             st.info(f"**Clinical Indication:**\n{analysis['reason']}")
+            if analysis.get("monitor_directive"):
+                st.caption(f"**Monitor:** {analysis['monitor_directive']}")
         with c2:
             st.metric("Acuity Score", f"{analysis['severity']}/10")
             st.caption(
@@ -676,37 +1130,28 @@ else:
             if st.button(
                 "✅ AUTHORIZE ADMISSION", type="primary", use_container_width=True
             ):
-                system.update_beds(target, analysis["ward_need"])
-                system.mission["status"] = "ACTIVE"
+                system.admit(target, analysis["ward_need"])
                 st.rerun()
         with b2:
             if st.button("❌ DIVERT (CAPACITY FULL)", use_container_width=True):
-                system.declined_hospitals.append(target)
-                system.mission["status"] = "DECLINED"
+                system.decline_hospital(target)
                 st.rerun()
         st.divider()
 
     st.caption("Live Bed Census & Transport Tracking")
-    total_icu = sum(h["icu_beds"] for h in system.hospitals.values())
-    total_op = sum(h["op_beds"] for h in system.hospitals.values())
     m1, m2, m3 = st.columns(3)
-    m1.metric("ICU Capacity", total_icu)
-    m2.metric("General Capacity", total_op)
+    m1.metric("ICU Capacity", system.total_icu)
+    m2.metric("General Capacity", system.total_op)
     m3.metric(
         "Active Inbound", "1" if system.mission["status"] != "IDLE" else "0"
     )
 
     st.subheader("📊 Network Census Board")
-    table = []
-    for h, d in system.hospitals.items():
-        table.append(
-            {
-                "Facility Name": h,
-                "ICU Vacancy": d["icu_beds"],
-                "Gen Ward Vacancy": d["op_beds"],
-                "Specialty": d["specialty"],
-            }
-        )
-    st.dataframe(
-        pd.DataFrame(table), use_container_width=True, hide_index=True
+    table = system.table
+    census = census_df(
+        tuple(table.names),
+        tuple(table.icu.tolist()),
+        tuple(table.op.tolist()),
+        tuple(rec["specialty"] for rec in table.records.values()),
     )
+    st.dataframe(census, use_container_width=True, hide_index=True)